@@ -1,13 +1,19 @@
 """pipen-log2file plugin: Save running logs to file"""
 from __future__ import annotations
 
+import atexit
+import os
+import re
 import sys
 import logging
+from copy import copy
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from math import ceil
+from queue import SimpleQueue
 from datetime import datetime
-from typing import TYPE_CHECKING, List
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Type
 
-from rich.markup import _parse
 from xqute.utils import logger as xqute_logger
 from pipen import plugin
 
@@ -18,45 +24,227 @@ if TYPE_CHECKING:  # pragma: no cover
 __version__ = "0.8.0"
 
 xqute_logger_handlers = xqute_logger.handlers
+# The logger for the messages from this plugin, which only go to the log file
+_logger = logging.getLogger("pipen_log2file")
+_logger.setLevel(logging.INFO)
+_logger.propagate = False
+_pipen_loggers_cache: List[logging.Logger] = []
+_pipen_loggers_cache_size = 0
+_BUFFER_SIZE = 65536
+# Same as rich.markup.RE_TAGS, with the escaping backslashes captured
+_RICH_TAG_RE = re.compile(r"(\\*)\[[a-z#/@][^[]*?]")
+# For text without escapes (the common case). _RICH_TAG_RE's leading (\\*)
+# forces a match attempt at every position, this pattern avoids that.
+_RICH_TAG_PLAIN_RE = re.compile(r"\[[a-z#/@][^[]*?]")
+
+
+def _unescape_rich_tag(match: re.Match) -> str:
+    """Keep the literal backslashes and escaped tags of a matched tag"""
+    escapes = match.group(1)
+    backslashes, escaped = divmod(len(escapes), 2)
+    tag = match.group(0)[len(escapes):] if escaped else ""
+    return "\\" * backslashes + tag
 
 
 def _remove_rich_tags(text: str) -> str:
     """Remove rich tags from text"""
-    return "".join(text for _, text, _ in _parse(text) if text)
+    if "[" not in text:
+        return text
+    if "\\" not in text:
+        return _RICH_TAG_PLAIN_RE.sub("", text)
+    return _RICH_TAG_RE.sub(_unescape_rich_tag, text)
+
+
+def _get_pipen_loggers() -> List[logging.Logger]:
+    """Get all pipen loggers
+
+    The list is cached. Since loggers are registered in order and never
+    removed, only the names registered after the last call are scanned.
+    """
+    global _pipen_loggers_cache_size
+
+    logger_dict = logging.root.manager.loggerDict
+    if len(logger_dict) < _pipen_loggers_cache_size:  # pragma: no cover
+        # Someone removed loggers from the manager, start over
+        _pipen_loggers_cache.clear()
+        _pipen_loggers_cache_size = 0
+
+    if len(logger_dict) != _pipen_loggers_cache_size:
+        new_names = list(islice(logger_dict, _pipen_loggers_cache_size, None))
+        _pipen_loggers_cache.extend(
+            logging.getLogger(name)
+            for name in new_names
+            if name.startswith("pipen.")
+        )
+        _pipen_loggers_cache_size = len(logger_dict)
+
+    return _pipen_loggers_cache
 
 
 def _add_handler(handler: logging.Handler | None):
-    """Get all loggers"""
+    """Add handler to all pipen loggers"""
     if not handler:
         return
 
-    for name in logging.root.manager.loggerDict:
-        if not name.startswith("pipen."):
-            continue
-        logger = logging.getLogger(name)
+    for logger in _get_pipen_loggers():
         if handler not in logger.handlers:
             logger.addHandler(handler)
 
 
 def _remove_handler(handler: logging.Handler | None):
-    """Remove handler from all loggers"""
+    """Remove handler from all pipen loggers"""
     if not handler:
         return
 
-    for name in logging.root.manager.loggerDict:
-        if not name.startswith("pipen."):
-            continue
-        logger = logging.getLogger(name)
+    for logger in _get_pipen_loggers():
         if handler in logger.handlers:
             logger.removeHandler(handler)
 
 
-class _RemoveRichMarkupFilter(logging.Filter):
-    """Remove rich tags from logs"""
+class _BufferedFileHandler(RotatingFileHandler):
+    """File handler that buffers the writes instead of flushing every record
+
+    The buffer is written by flush(), which is called by _DrainQueueListener
+    once the queue is drained, and by close().
+
+    The file is rotated like RotatingFileHandler, but the size is tracked
+    here, since shouldRollover() seeks the stream and flushes the buffer.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Only tracked when rotating, see set_rotation()
+        self._size = 0
+
+    def _rotating(self) -> bool:
+        return self.maxBytes > 0 and self.backupCount > 0
+
+    def set_rotation(self, max_bytes: int, backup_count: int):
+        """Turn on the rotation, counting what is already written"""
+        # Under the lock, the listener thread may be emitting
+        with self.lock:
+            self.maxBytes = max_bytes
+            self.backupCount = backup_count
+            if not self._rotating():
+                return
+            if self.stream is not None:
+                # Opened in append mode, includes the buffered writes
+                self._size = self.stream.tell()
+                return
+            try:
+                self._size = os.path.getsize(self.baseFilename)
+            except OSError:
+                self._size = 0
+
+    def _open(self):
+        return open(
+            self.baseFilename,
+            self.mode,
+            buffering=_BUFFER_SIZE,
+            encoding=self.encoding,
+            errors=self.errors,
+        )
 
-    def filter(self, record: logging.LogRecord) -> bool:
-        record.msg = _remove_rich_tags(record.msg)
-        return True
+    def emit(self, record: logging.LogRecord):
+        # StreamHandler.emit() flushes the stream after each record
+        try:
+            msg = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            if self._rotating():
+                # maxBytes is in bytes, not characters (✔ and box drawings)
+                size = (
+                    len(msg)
+                    if msg.isascii()
+                    else len(
+                        msg.encode(self.stream.encoding, self.stream.errors)
+                    )
+                )
+                if self._size > 0 and self._size + size > self.maxBytes:
+                    self.doRollover()
+                    self._size = 0
+                    if self.stream is None:
+                        self.stream = self._open()
+                self._size += size
+            self.stream.write(msg)
+        except RecursionError:  # pragma: no cover
+            raise
+        except Exception:  # pragma: no cover
+            self.handleError(record)
+
+
+class _DrainQueueListener(QueueListener):
+    """Queue listener that flushes the handlers when the queue is drained
+
+    So records coming in bursts are written together, and the files are
+    still up to date when the pipeline is idle.
+    """
+
+    def handle(self, record: logging.LogRecord):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+def _start_queue_listener(
+    handler: logging.Handler,
+    queue_handler_class: Type[QueueHandler] = QueueHandler,
+) -> Tuple[QueueHandler, QueueListener]:
+    """Start a listener thread that writes the queued records to handler
+
+    Returns the handler to attach to the loggers and the listener.
+    """
+    queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+    listener = _DrainQueueListener(queue, handler)
+    listener.start()
+    return queue_handler_class(queue), listener
+
+
+class _RemoveRichMarkupQueueHandler(QueueHandler):
+    """Queue handler that removes rich tags from the messages
+
+    Tags are removed from the interpolated message only, before format()
+    appends the traceback, whose source lines may look like tags (data[key]).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Same as QueueHandler.prepare(), but with a single copy of the
+        # record, which is shared with other handlers
+        record = copy(record)
+        record.msg = _remove_rich_tags(record.getMessage())
+        record.args = None
+        msg = self.format(record)
+        record.message = msg
+        record.msg = msg
+        record.exc_info = None
+        record.exc_text = None
+        record.stack_info = None
+        return record
+
+
+class _CachedTimeFormatter(logging.Formatter):
+    """Formatter that formats the time of records only once per second"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._asctime_cache: Tuple[int, str] = (-1, "")
+
+    def formatTime(
+        self,
+        record: logging.LogRecord,
+        datefmt: str | None = None,
+    ) -> str:
+        # Without datefmt, msecs are included and the time can't be reused
+        if not datefmt:
+            return super().formatTime(record, datefmt)
+
+        seconds = int(record.created)
+        cached_seconds, asctime = self._asctime_cache
+        if seconds != cached_seconds:
+            asctime = super().formatTime(record, datefmt)
+            self._asctime_cache = (seconds, asctime)
+        return asctime
 
 
 class PipenLog2FilePlugin:
@@ -66,9 +254,33 @@ class PipenLog2FilePlugin:
     __version__: str = __version__
 
     def __init__(self) -> None:
-        self._handler: logging.FileHandler | None = None
+        self._handler: _BufferedFileHandler | None = None
+        # Records are put into the queue by the loggers and written to
+        # the file by the listener thread, so the event loop is not blocked
+        self._queue_handler: QueueHandler | None = None
+        self._listener: QueueListener | None = None
         self._job_progress: List[str] = []
+        # proc name => (width of the job index, number of jobs per line)
+        self._job_index_formats: Dict[str, Tuple[int, int]] = {}
         self._xqute_handler: logging.Handler | None = None
+        self._xqute_queue_handler: QueueHandler | None = None
+        self._xqute_listener: QueueListener | None = None
+        # Shared by the xqute handlers of all procs
+        self._xqute_formatter = _CachedTimeFormatter(
+            "%(asctime)s %(levelname)-7s %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+
+    @plugin.impl
+    def on_setup(self, config: Dict[str, Any]):
+        """Set the default options
+
+        Here, instead of in on_init(), so the values from the config files,
+        which are loaded before on_init(), are not overwritten
+        """
+        plugin_opts = config["plugin_opts"]
+        plugin_opts.setdefault("log2file_max_bytes", 100 * 1024 * 1024)
+        plugin_opts.setdefault("log2file_backup_count", 5)
 
     @plugin.impl
     async def on_init(self, pipen: Pipen):
@@ -88,35 +300,48 @@ class PipenLog2FilePlugin:
         if self._handler:  # pragma: no cover
             return
 
-        logfile = pipen.workdir.joinpath(
-            ".logs",
-            f"run-{datetime.now():%Y_%m_%d_%H_%M_%S}.log"
-        )
-        logfile.parent.mkdir(parents=True, exist_ok=True)
+        logs_dir = pipen.workdir.joinpath(".logs")
+        logs_dir.mkdir(parents=True, exist_ok=True)
+        logname = f"run-{datetime.now():%Y_%m_%d_%H_%M_%S}.log"
+        logfile = logs_dir.joinpath(logname)
         latest_log = pipen.workdir.joinpath("run-latest.log")
-        if latest_log.exists() or latest_log.is_symlink():
-            latest_log.unlink()
-        latest_log.symlink_to(logfile.relative_to(pipen.workdir))
+        # A single unlink() call also covers broken symlinks
+        latest_log.unlink(missing_ok=True)
+        # Relative to the workdir, no need to compute it by relative_to()
+        latest_log.symlink_to(os.path.join(".logs", logname))
 
-        self._handler = logging.FileHandler(logfile, delay=True)
+        self._handler = _BufferedFileHandler(logfile, delay=True)
         self._handler.setFormatter(
-            logging.Formatter(
+            _CachedTimeFormatter(
                 "%(asctime)s %(levelname)-1.1s %(plugin_name)-7s %(message)s",
                 datefmt="%m-%d %H:%M:%S",
             )
         )
-        self._handler.addFilter(_RemoveRichMarkupFilter())
-        _add_handler(self._handler)
+        self._queue_handler, self._listener = _start_queue_listener(
+            self._handler,
+            _RemoveRichMarkupQueueHandler,
+        )
+        _add_handler(self._queue_handler)
+        _logger.addHandler(self._queue_handler)
+
+    @plugin.impl
+    async def on_start(self, pipen: Pipen):
+        """Set up the rotation of the log file
+
+        The options passed to Pipen() are not loaded yet in on_init()
+        """
+        if not self._handler:
+            return
+
+        self._handler.set_rotation(
+            pipen.config.plugin_opts.log2file_max_bytes,
+            pipen.config.plugin_opts.log2file_backup_count,
+        )
 
     @plugin.impl
     async def on_complete(self, pipen: Pipen, succeeded: bool):
         """Remove the handler in case logger is used by other pipelines"""
-        _remove_handler(self._handler)
-        try:
-            self._handler.close()
-        except Exception:  # pragma: no cover
-            pass
-        self._handler = None
+        self._close_handler()
 
     @plugin.impl
     async def on_job_succeeded(self, job: Job):
@@ -133,58 +358,88 @@ class PipenLog2FilePlugin:
     @plugin.impl
     async def on_proc_start(self, proc: Proc):
         """Also save xqute logs"""
+        # Used to format the job progress
+        width = len(str(proc.size - 1))
+        self._job_index_formats[proc.name] = (width, ceil(55.0 / (width + 2)))
+
         if not proc.plugin_opts.log2file_xqute:
             return
 
         logfile = proc.workdir.joinpath("proc.xqute.log")
-        if not proc.plugin_opts.log2file_xqute_append and logfile.exists():
-            logfile.unlink()
-
-        self._xqute_handler = logging.FileHandler(logfile, delay=True)
-        self._xqute_handler.setFormatter(
-            logging.Formatter(
-                "%(asctime)s %(levelname)-7s %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S",
-            )
+        if not proc.plugin_opts.log2file_xqute_append:
+            logfile.unlink(missing_ok=True)
+
+        self._xqute_handler = _BufferedFileHandler(logfile, delay=True)
+        self._xqute_handler.setFormatter(self._xqute_formatter)
+        self._xqute_queue_handler, self._xqute_listener = (
+            _start_queue_listener(self._xqute_handler)
         )
-        # handler.addFilter(_RemoveRichMarkupFilter())
-        xqute_logger.addHandler(self._xqute_handler)
+        xqute_logger.addHandler(self._xqute_queue_handler)
         xqute_logger.setLevel(proc.plugin_opts.log2file_xqute_level.upper())
 
     @plugin.impl
     async def on_proc_done(self, proc: Proc, succeeded: bool | str):
+        self._close_xqute_handler()
+        self._job_index_formats.pop(proc.name, None)
+        if not self._handler:
+            return
+
+        self._emit_log_progress(proc.name)
+
+    def _close_handler(self):
+        """Stop the listener and close the handler of the pipeline log"""
+        if not self._handler:
+            return
+
+        _remove_handler(self._queue_handler)
+        _logger.removeHandler(self._queue_handler)
+        # Wait for the queued records to be written
+        if self._listener:
+            self._listener.stop()
+        try:
+            self._handler.close()
+        except Exception:  # pragma: no cover
+            pass
+        self._handler = None
+        self._queue_handler = None
+        self._listener = None
+
+    def _close_xqute_handler(self):
+        """Stop the listener and close the handler of the xqute log"""
         if (
-            self._xqute_handler
-            and self._xqute_handler in xqute_logger.handlers
+            self._xqute_queue_handler
+            and self._xqute_queue_handler in xqute_logger.handlers
         ):
-            xqute_logger.removeHandler(self._xqute_handler)
+            xqute_logger.removeHandler(self._xqute_queue_handler)
+            self._xqute_listener.stop()
             try:
                 self._xqute_handler.close()
             except Exception:  # pragma: no cover
                 pass
             self._xqute_handler = None
+            self._xqute_queue_handler = None
+            self._xqute_listener = None
 
-        if not self._handler:
-            return
+    def _close_handlers(self):
+        """Close all handlers at exit
 
-        self._emit_log_progress(proc.name)
+        on_complete() and on_proc_done() are not called when the pipeline
+        raises, the queued records would be lost with the listener threads.
+        """
+        self._close_xqute_handler()
+        self._close_handler()
 
     def _emit_log_progress(self, procname: str):
         """Emit the job progress"""
         if not self._handler or not self._job_progress:
             return
 
-        record = logging.LogRecord(
-            name="pipen.main",
-            level=logging.INFO,
-            pathname="",
-            lineno=0,
-            msg=f'{procname}: Progress {" ".join(self._job_progress)}',
-            args=(),
-            exc_info=None,
+        _logger.info(
+            "%s: Progress %s",
+            procname,
+            " ".join(self._job_progress),
+            extra={"plugin_name": "log2f"},
         )
-        record.plugin_name = "log2f"
-        self._handler.emit(record)
         self._job_progress.clear()
 
     def _log_job_progress(self, job: Job, status: str):
@@ -192,11 +447,12 @@ class PipenLog2FilePlugin:
         if not self._handler:
             return
 
-        job_index = str(job.index).zfill(len(str(job.proc.size - 1)))
-        njobs_per_line = ceil(55.0 / (len(job_index) + 2))
-        self._job_progress.append(f"{job_index}{status}")
+        procname = job.proc.name
+        width, njobs_per_line = self._job_index_formats[procname]
+        self._job_progress.append(f"{job.index:0{width}d}{status}")
         if len(self._job_progress) == njobs_per_line:
-            self._emit_log_progress(job.proc.name)
+            self._emit_log_progress(procname)
 
 
 log2file_plugin = PipenLog2FilePlugin()
+atexit.register(log2file_plugin._close_handlers)
@@ -0,0 +1,23 @@
+from pipen import Pipen, Proc
+
+
+class P(Proc):
+    """Process"""
+    input = "in"
+    input_data = list(range(30))
+    output = "out:var:{{in.in}}"
+    script = "echo 123"
+
+
+class PipelineRotate(Pipen):
+    """The pipeline"""
+    starts = P
+    forks = 10
+    plugin_opts = {
+        "log2file_max_bytes": 1000,
+        "log2file_backup_count": 100,
+    }
+
+
+if __name__ == "__main__":
+    PipelineRotate().run()
@@ -0,0 +1,19 @@
+from pipen import Pipen, Proc
+
+
+class P(Proc):
+    """Process"""
+    input = "in"
+    input_data = list(range(30))
+    output = "out:var:{{in.in}}"
+    script = "echo 123"
+
+
+class PipelineRotateConfig(Pipen):
+    """The pipeline with the rotation options from .pipen.toml"""
+    starts = P
+    forks = 10
+
+
+if __name__ == "__main__":
+    PipelineRotateConfig().run()
@@ -0,0 +1,107 @@
+"""Test the contents of the log files"""
+import sys
+import logging
+import subprocess
+import threading
+from pathlib import Path
+
+from pipen_log2file import (
+    PipenLog2FilePlugin,
+    _BufferedFileHandler,
+    _RemoveRichMarkupQueueHandler,
+    _logger,
+    _start_queue_listener,
+)
+
+HERE = Path(__file__).resolve().parent
+
+
+def _run(script, cwd):
+    return subprocess.run(
+        [sys.executable, str(HERE / script)],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    ).returncode
+
+
+def test_queued_records_written_when_handlers_closed(tmp_path):
+    # What the atexit hook does when on_complete() is not reached
+    release = threading.Event()
+
+    class BlockingHandler(_BufferedFileHandler):
+        def emit(self, record):
+            release.wait()
+            super().emit(record)
+
+    logfile = tmp_path.joinpath("run.log")
+    handler = BlockingHandler(logfile, delay=True)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    queue_handler, listener = _start_queue_listener(
+        handler,
+        _RemoveRichMarkupQueueHandler,
+    )
+    plugin = PipenLog2FilePlugin()
+    plugin._handler = handler
+    plugin._queue_handler = queue_handler
+    plugin._listener = listener
+    _logger.addHandler(queue_handler)
+
+    timer = threading.Timer(0.5, release.set)
+    try:
+        for i in range(1000):
+            _logger.info("[green]Line[/green] %s", i)
+
+        # All records are still queued or held by the blocked listener
+        assert not logfile.exists()
+        timer.start()
+        plugin._close_handlers()
+    finally:
+        # Don't leave the listener blocked when an assertion fails
+        timer.cancel()
+        release.set()
+        plugin._close_handlers()
+
+    assert plugin._handler is None
+    assert queue_handler not in _logger.handlers
+    lines = logfile.read_text().splitlines()
+    assert lines == [f"Line {i}" for i in range(1000)]
+
+
+def _assert_rotated(workdir):
+    logfile = workdir.joinpath("run-latest.log").resolve()
+    rotated = logfile.with_name(f"{logfile.name}.1")
+    assert rotated.exists()
+    # log2file_max_bytes
+    assert 0 < rotated.stat().st_size <= 1000
+    assert logfile.stat().st_size <= 1000
+
+
+def test_log_rotated(tmp_path):
+    assert _run("pipeline_rotate.py", tmp_path) == 0
+    _assert_rotated(tmp_path.joinpath(".pipen", "PipelineRotate"))
+
+
+def test_log_rotated_with_config_file(tmp_path):
+    # Loaded from the working directory before on_init
+    tmp_path.joinpath(".pipen.toml").write_text(
+        "[plugin_opts]\n"
+        "log2file_max_bytes = 1000\n"
+        "log2file_backup_count = 100\n"
+    )
+    assert _run("pipeline_rotate_config.py", tmp_path) == 0
+    _assert_rotated(tmp_path.joinpath(".pipen", "PipelineRotateConfig"))
+
+
+def test_log_contents(tmp_path):
+    assert _run("pipeline.py", tmp_path) == 0
+    workdir = tmp_path.joinpath(".pipen", "Pipeline")
+    log = workdir.joinpath("run-latest.log").read_text()
+    # rich tags removed
+    assert "P: <<< [START]" in log
+    assert "[yellow]" not in log
+    assert " log2f   P: Progress 0✔" in log
+
+    xqute_log = workdir.joinpath("P", "proc.xqute.log").read_text()
+    assert "Job-0" in xqute_log
+    assert xqute_log.rstrip().endswith("Done!")
@@ -0,0 +1,23 @@
+"""Test the cached pipen loggers that the handlers are added to"""
+import logging
+
+from pipen_log2file import _add_handler, _remove_handler
+
+
+def test_new_loggers_get_the_handler():
+    handler = logging.NullHandler()
+    _add_handler(handler)
+
+    # Registering the child also registers a placeholder for the parent
+    child = logging.getLogger("pipen.log2file_test.child")
+    _add_handler(handler)
+    parent = logging.getLogger("pipen.log2file_test")
+    other = logging.getLogger("log2file_test")
+
+    assert handler in child.handlers
+    assert handler in parent.handlers
+    assert handler not in other.handlers
+
+    _remove_handler(handler)
+    assert handler not in child.handlers
+    assert handler not in parent.handlers
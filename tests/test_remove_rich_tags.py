@@ -0,0 +1,75 @@
+"""Test that rich tags are removed the same way as rich's markup parser"""
+import logging
+from queue import SimpleQueue
+
+import pytest
+from rich.markup import _parse
+
+from pipen_log2file import _RemoveRichMarkupQueueHandler, _remove_rich_tags
+
+
+def _rich_remove_rich_tags(text):
+    return "".join(text for _, text, _ in _parse(text) if text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "No tags at all",
+        "P: Workdir: '/path/to/workdir'",
+        "[bold]Bold[/bold] text",
+        "P: [yellow]<<<[/yellow] [START]",
+        "[bold magenta]Multiple styles[/]",
+        "[link=https://example.com]link[/link]",
+        "[#ff0000]hex color[/#ff0000]",
+        "[@click=app.bell]action[/]",
+        "Not tags: [1, 2, 3] [] [ ] [A]",
+        "Escaped \\[bold]tag[/bold]",
+        "Backslash \\\\[bold]tag[/bold]",
+        "Three \\\\\\[bold]tag",
+        "Unclosed [bold tag",
+        "Nested [a[b]c]",
+    ],
+)
+def test_remove_rich_tags(text):
+    assert _remove_rich_tags(text) == _rich_remove_rich_tags(text)
+
+
+def test_traceback_not_stripped():
+    queue = SimpleQueue()
+    handler = _RemoveRichMarkupQueueHandler(queue)
+    logger = logging.getLogger("pipen.test_traceback_not_stripped")
+    logger.addHandler(handler)
+    data = {}
+    try:
+        data["key"]
+    except KeyError:
+        logger.exception("[red]Failed[/red]: %s", "[bold]data[/bold]")
+    logger.removeHandler(handler)
+
+    msg = queue.get().msg
+    assert msg.startswith("Failed: data\nTraceback")
+    assert 'data["key"]' in msg
+
+
+def test_message_interpolated_once():
+    class Arg:
+        calls = 0
+
+        def __str__(self):
+            Arg.calls += 1
+            return "arg"
+
+    queue = SimpleQueue()
+    handler = _RemoveRichMarkupQueueHandler(queue)
+    record = logging.LogRecord(
+        "pipen.test", logging.INFO, __file__, 0, "Arg: %s", (Arg(),), None
+    )
+    handler.handle(record)
+
+    assert queue.get().msg == "Arg: arg"
+    assert Arg.calls == 1
+    # The shared record is left untouched
+    assert record.msg == "Arg: %s"
+    assert record.args